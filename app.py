@@ -1,102 +1,168 @@
 
 import streamlit as st
 import os
+import re
 import sqlite3
 import tempfile
+import shutil
+import hashlib
+from pathlib import Path
 import pandas as pd
 import io
-import google.generativeai as genai
 from dotenv import load_dotenv
 
-if "schema_info" not in st.session_state:
-    st.session_state["schema_info"] = None
-
-# Try to get API key from Streamlit Secrets (Streamlit Cloud)
-api_key = st.secrets.get("API_KEY", None)
-
-# Configure Gemini
-genai.configure(api_key=api_key)
+# Opens a SQLite database for querying
+# The app only reads, so the file is opened read-only and memory-mapped so repeated
+# queries are served from the page cache. Uploads are private snapshots and are also
+# opened immutable (no locking or change detection)
+def open_conn(db_path, immutable=True):
+    uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+# Shared connection per database file, reused across reruns and sessions
+# (used for the sample database; uploads get their own connection per session)
+# Not immutable, since the sample file can be regenerated by sql.py while the app runs
+@st.cache_resource
+def get_conn(db_path):
+    return open_conn(db_path, immutable=False)
+
+# Releases the session's database and resets the related session state
+# An uploaded database owns its connection, which is closed here; the sample
+# database connection is shared across sessions and is left open
+def release_db():
+    if st.session_state['conn'] is not None and not st.session_state['is_sample']:
+        st.session_state['conn'].close()
+
+    # Temp files are only still on disk where they couldn't be unlinked while open
+    if st.session_state['tmp_path'] and os.path.exists(st.session_state['tmp_path']):
+        os.unlink(st.session_state['tmp_path'])
+
+    st.session_state['conn'] = None
+    st.session_state['is_sample'] = False
+    st.session_state['tmp_path'] = None
+    st.session_state['db_key'] = None
+    st.session_state['uploaded_file_name'] = None
 
-# Function to extract comprehensive schema information from a SQLite database
-def extract_schema_info(db_path):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+# Column and foreign key details for every user table, fetched in one query.
+# Rows are ordered by table, then columns (by cid) before foreign keys (by id, seq).
+SCHEMA_QUERY = '''
+SELECT m.rowid, m.name, 'C', p.cid, 0,
+       p.name, p.type, p."notnull", p.dflt_value, p.pk, NULL, NULL
+FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p
+WHERE m.type = 'table' AND m.name NOT GLOB 'sqlite_*'
+UNION ALL
+SELECT m.rowid, m.name, 'F', f.id, f.seq,
+       f."from", NULL, NULL, NULL, NULL, f."table", f."to"
+FROM sqlite_master AS m JOIN pragma_foreign_key_list(m.name) AS f
+WHERE m.type = 'table' AND m.name NOT GLOB 'sqlite_*'
+ORDER BY 1, 3, 4, 5
+'''
 
-    # Get list of tables
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
+# Quotes an SQL identifier, doubling any embedded double quotes
+# Always quoting also covers names that are SQL keywords, such as order or group
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
 
-    schema_info = {}
+# Table-valued pragma functions (pragma_table_info, ...) need SQLite 3.16+
+HAS_PRAGMA_FUNCTIONS = sqlite3.sqlite_version_info >= (3, 16, 0)
 
-    for table in tables:
-        table_name = table[0]
+# Fallback for older SQLite: builds the same rows as SCHEMA_QUERY from
+# per-table PRAGMA statements (executescript can't batch them, it discards results)
+def legacy_schema_rows(cursor):
+    cursor.execute("SELECT rowid, name FROM sqlite_master WHERE type='table' ORDER BY rowid")
+    rows = []
+    for rowid, table_name in cursor.fetchall():
         # Skip SQLite internal tables
         if table_name.startswith('sqlite_'):
             continue
 
-        # Get column information for this table
-        cursor.execute(f"PRAGMA table_info('{table_name}')")
-        columns = cursor.fetchall()
+        quoted = quote_ident(table_name)
+        for col in cursor.execute(f"PRAGMA table_info({quoted})").fetchall():
+            rows.append((rowid, table_name, 'C', col[0], 0, col[1], col[2], col[3], col[4], col[5], None, None))
+        for fk in cursor.execute(f"PRAGMA foreign_key_list({quoted})").fetchall():
+            rows.append((rowid, table_name, 'F', fk[0], fk[1], fk[3], None, None, None, None, fk[2], fk[4]))
+    return rows
 
-        # Format: (cid, name, type, notnull, dflt_value, pk)
-        col_info = []
-        for col in columns:
-            col_info.append({
-                'name': col[1],
-                'type': col[2] if col[2] else 'TEXT',
-                'nullable': not col[3],
-                'default': col[4],
-                'primary_key': bool(col[5])
-            })
+# Function to extract comprehensive schema information from a SQLite database
+# Cached on db_key (a content hash or mtime) so reruns don't re-read the schema;
+# the connection is excluded from the cache key
+@st.cache_data(show_spinner=False)
+def extract_schema_info(db_key, _conn):
+    cursor = _conn.cursor()
+    if HAS_PRAGMA_FUNCTIONS:
+        cursor.execute(SCHEMA_QUERY)
+        rows = cursor.fetchall()
+    else:
+        rows = legacy_schema_rows(cursor)
 
-        # Get foreign key information
-        cursor.execute(f"PRAGMA foreign_key_list('{table_name}')")
-        foreign_keys = cursor.fetchall()
+    schema_info = {}
 
-        fk_info = []
-        for fk in foreign_keys:
-            fk_info.append({
-                'from': fk[3],
-                'to_table': fk[2],
-                'to_column': fk[4]
+    for row in rows:
+        table_name, kind = row[1], row[2]
+        info = schema_info.setdefault(table_name, {
+            'columns': [],
+            'foreign_keys': []
+        })
+
+        if kind == 'C':
+            # Case-fold the type once here instead of on every prompt build
+            col_type = row[6] if row[6] else 'TEXT'
+            type_lower = col_type.lower()
+            info['columns'].append({
+                'name': row[5],
+                'type': col_type,
+                'type_upper': col_type.upper(),
+                'is_numeric': any(k in type_lower for k in ('int', 'number', 'float')),
+                'is_text': any(k in type_lower for k in ('char', 'text', 'varchar')),
+                'nullable': not row[7],
+                'default': row[8],
+                'primary_key': bool(row[9])
+            })
+        else:
+            info['foreign_keys'].append({
+                'from': row[5],
+                'to_table': row[10],
+                'to_column': row[11]
             })
 
-        schema_info[table_name] = {
-            'columns': col_info,
-            'foreign_keys': fk_info
-        }
-
-    conn.close()
+    cursor.close()
     return schema_info
 
 # Function to generate a comprehensive prompt based on schema information
+@st.cache_data(show_spinner=False)
 def generate_prompt(schema_info):
-    prompt = "You are an expert in converting English questions to SQL queries!\n\n"
+    # Collect the pieces in a list and join once at the end
+    parts = ["You are an expert in converting English questions to SQL queries!\n\n"]
 
     # Add database schema information
-    prompt += "Database Schema:\n"
+    parts.append("Database Schema:\n")
 
     for table_name, info in schema_info.items():
         columns = info['columns']
         foreign_keys = info['foreign_keys']
 
-        prompt += f"\nTable: {table_name}\n"
-        prompt += "Columns:\n"
+        parts.append(f"\nTable: {table_name}\n")
+        parts.append("Columns:\n")
 
         for col in columns:
-            col_type = col['type'].upper()
+            col_type = col['type_upper']
             pk = " (PRIMARY KEY)" if col['primary_key'] else ""
             nullable = " NOT NULL" if not col['nullable'] else ""
             default = f" DEFAULT {col['default']}" if col['default'] is not None else ""
-            prompt += f"  - {col['name']} ({col_type}{pk}{nullable}{default})\n"
+            parts.append(f"  - {col['name']} ({col_type}{pk}{nullable}{default})\n")
 
         if foreign_keys:
-            prompt += "Foreign Keys:\n"
+            parts.append("Foreign Keys:\n")
             for fk in foreign_keys:
-                prompt += f"  - {fk['from']} REFERENCES {fk['to_table']}({fk['to_column']})\n"
+                parts.append(f"  - {fk['from']} REFERENCES {fk['to_table']}({fk['to_column']})\n")
 
     # Add examples based on the schema
-    prompt += "\nSQL Examples:\n"
+    parts.append("\nSQL Examples:\n")
 
     tables = list(schema_info.keys())
     if tables:
@@ -104,33 +170,36 @@ def generate_prompt(schema_info):
         table_name = tables[0]
         columns = schema_info[table_name]['columns']
 
-        prompt += f"\nExample 1: How many records are in {table_name}?\n"
-        prompt += f"SELECT COUNT(*) FROM {table_name};\n"
+        table_sql = quote_ident(table_name)
+
+        parts.append(f"\nExample 1: How many records are in {table_name}?\n")
+        parts.append(f"SELECT COUNT(*) FROM {table_sql};\n")
 
         # Add more examples if we have enough columns
         if len(columns) >= 2:
             col1 = columns[0]['name']
             col2 = columns[1]['name']
-            col1_type = columns[0]['type'].lower()
+            col1_sql = quote_ident(col1)
 
             # Adjust examples based on column type
-            if 'int' in col1_type or 'number' in col1_type or 'float' in col1_type:
-                prompt += f"\nExample 2: List all records where {col1} is greater than 50.\n"
-                prompt += f"SELECT * FROM {table_name} WHERE {col1} > 50;\n"
-            elif 'char' in col1_type or 'text' in col1_type or 'varchar' in col1_type:
-                prompt += f"\nExample 2: List all records where {col1} contains 'value'.\n"
-                prompt += f"SELECT * FROM {table_name} WHERE {col1} LIKE '%value%';\n"
+            if columns[0]['is_numeric']:
+                parts.append(f"\nExample 2: List all records where {col1} is greater than 50.\n")
+                parts.append(f"SELECT * FROM {table_sql} WHERE {col1_sql} > 50;\n")
+            elif columns[0]['is_text']:
+                parts.append(f"\nExample 2: List all records where {col1} contains 'value'.\n")
+                parts.append(f"SELECT * FROM {table_sql} WHERE {col1_sql} LIKE '%value%';\n")
             else:
-                prompt += f"\nExample 2: List all records sorted by {col1}.\n"
-                prompt += f"SELECT * FROM {table_name} ORDER BY {col1};\n"
+                parts.append(f"\nExample 2: List all records sorted by {col1}.\n")
+                parts.append(f"SELECT * FROM {table_sql} ORDER BY {col1_sql};\n")
 
             if len(columns) >= 3:
                 col3 = columns[2]['name']
-                prompt += f"\nExample 3: Count records grouped by {col3}.\n"
-                prompt += f"SELECT {col3}, COUNT(*) FROM {table_name} GROUP BY {col3};\n"
+                col3_sql = quote_ident(col3)
+                parts.append(f"\nExample 3: Count records grouped by {col3}.\n")
+                parts.append(f"SELECT {col3_sql}, COUNT(*) FROM {table_sql} GROUP BY {col3_sql};\n")
 
     # Add guidelines for generating SQL queries
-    prompt += '''
+    parts.append('''
 
 Guidelines for SQL generation:
 1. Use proper SQL syntax with correct keywords
@@ -141,48 +210,122 @@ Guidelines for SQL generation:
 6. Include GROUP BY when using aggregate functions
 7. Always validate column and table names exist in the schema
 8. Return only valid executable SQL queries
-'''
+''')
+
+    return "".join(parts)
+
+# Function to pre-render the schema display blocks, one (table, columns, foreign keys) per table
+@st.cache_data(show_spinner=False)
+def render_schema_html(schema_info):
+    blocks = []
 
-    return prompt
+    for table_name, info in schema_info.items():
+        columns = info['columns']
+        foreign_keys = info['foreign_keys']
+
+        # Create column information display
+        col_info = ""
+        for col in columns:
+            col_type = col['type']
+            pk = "🔑 " if col['primary_key'] else ""
+            nullable = "NULL" if col['nullable'] else "NOT NULL"
+            default = f" (default: {col['default']})" if col['default'] is not None else ""
+            col_info += f"{pk}{col['name']} → {col_type}, {nullable}{default}\n"
+        col_html = f"<div class='schema'><pre>{col_info}</pre></div>"
+
+        # Foreign keys block, if any
+        fk_html = None
+        if foreign_keys:
+            fk_info = "Foreign Keys:\n"
+            for fk in foreign_keys:
+                fk_info += f"  {fk['from']} → {fk['to_table']}.{fk['to_column']}\n"
+            fk_html = f"<div class='schema'><pre>{fk_info}</pre></div>"
+
+        blocks.append((table_name, col_html, fk_html))
+
+    return blocks
+
+# Gemini model, configured and built once per process
+# google.generativeai is imported here so its import cost is only paid on the first query
+@st.cache_resource
+def get_model():
+    import google.generativeai as genai
+
+    # Try to get API key from Streamlit Secrets (Streamlit Cloud)
+    api_key = st.secrets.get("API_KEY", None)
+
+    # Configure Gemini
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel("gemini-2.0-flash")
 
 # Gemini Function
+# Cached so resubmitting the same question against the same schema skips the API call
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_response(que, prompt):
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    response = model.generate_content([prompt, que])
+    response = get_model().generate_content([prompt, que])
     return response.text
 
-# SQL Runner
-def read_query(sql, db):
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
-
-# Function to get column names for a query result
-def get_column_names(sql, db):
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    cursor.execute(sql)
+# Maximum number of result rows fetched and displayed per query
+MAX_ROWS = 1000
+
+# Number of rows read and written per chunk when exporting results to CSV
+EXPORT_CHUNK_ROWS = 10_000
+
+# Chunk size used when hashing and copying uploaded files
+COPY_CHUNK_SIZE = 1 << 20
+
+# Markdown code fences around the model's answer, with an optional language tag
+# (```sql, ```SQL, ```sqlite, ...), stripped in a single pass
+FENCE_RE = re.compile(r"^\s*```(?:sql\b|\w*(?=[ \t]*\n))?\s*|\s*```\s*$", re.IGNORECASE)
+
+# Any LIMIT keyword in a query, used to avoid adding a second one
+LIMIT_RE = re.compile(r"\blimit\b", re.IGNORECASE)
+
+# Appends a LIMIT so ORDER BY queries can use a top-N sort; queries that already
+# mention LIMIT, or have anything after a ';' (such as a trailing comment), are
+# left as-is, since the LIMIT would otherwise become a second statement
+def limit_sql(sql, limit):
+    body = sql.rstrip().rstrip(';')
+    if LIMIT_RE.search(body) or ';' in body:
+        return sql
+    return body + f"\nLIMIT {limit}"
+
+# SQL Runner: prepares and executes the query once, returning both the rows
+# and the column names from the same cursor
+# Fetches at most max_rows + 1 rows so truncation can be detected without
+# pulling the whole result set into memory
+def run_select(sql, conn, max_rows=MAX_ROWS):
+    cursor = conn.execute(limit_sql(sql, max_rows + 1))
     names = [description[0] for description in cursor.description]
-    conn.close()
-    return names
+    # Size the fetch batch to the row budget so it is read in a single call
+    cursor.arraysize = max_rows + 1
+    rows = cursor.fetchmany(cursor.arraysize)
+    cursor.close()
+    return rows, names
+
+# Checks that the SQL is one complete statement SQLite can compile, without running it
+# EXPLAIN only prepares the query, so unknown tables or columns fail here cheaply
+def validate_sql(sql, conn):
+    # The terminator goes on its own line so a trailing -- comment can't swallow it
+    if not sqlite3.complete_statement(sql + '\n;'):
+        raise ValueError("The generated SQL statement is incomplete.")
+    conn.execute("EXPLAIN " + sql).close()
+
+# Builds the CSV of the full query result, reading it one chunk at a time so
+# only one chunk is ever held as a DataFrame. The CSV bytes themselves are
+# held in memory in full: Streamlit keeps the returned data in its media storage
+def export_csv(sql, conn):
+    with io.BytesIO() as buffer:
+        for i, chunk in enumerate(pd.read_sql_query(sql, conn, chunksize=EXPORT_CHUNK_ROWS)):
+            chunk.to_csv(buffer, index=False, header=(i == 0))
+        return buffer.getvalue()
 
 # Function to display query results with enhanced features
-def display_query_results(result, col_names, max_rows=1000):
+def display_query_results(result, col_names, sql, conn, max_rows=MAX_ROWS):
     if not result:
         st.warning("⚠️ No results found for this query.")
         return
 
-    # Convert to dictionary for display
-    result_dicts = []
-    for row in result[:max_rows]:  # Limit to max_rows
-        row_dict = {}
-        for i, col in enumerate(col_names):
-            row_dict[col] = row[i]
-        result_dicts.append(row_dict)
-
     # Display the results
     st.markdown("<div class='response'>", unsafe_allow_html=True)
     st.subheader("📥 Query Result:")
@@ -190,140 +333,36 @@ def display_query_results(result, col_names, max_rows=1000):
     # Show how many rows were returned
     total_rows = len(result)
     if total_rows > max_rows:
-        st.info(f"Showing {max_rows} of {total_rows} rows. The results have been truncated.")
+        st.info(f"Showing the first {max_rows} rows. The CSV download contains the full result.")
     else:
         st.info(f"Found {total_rows} rows.")
 
     # Display the data
-    df = pd.DataFrame(result_dicts)
-    st.dataframe(df, use_container_width=True)
+    df = pd.DataFrame.from_records(result[:max_rows], columns=col_names)
+    st.dataframe(df, width="stretch")
 
     # Add export option
-    if result_dicts:
-        # Create a download button for CSV export
-        csv = df.to_csv(index=False)
+    if not df.empty:
+        # Create a download button for CSV export; the CSV is only built on click
         st.download_button(
             label="📥 Download results as CSV",
-            data=csv,
+            data=lambda: export_csv(sql, conn),
             file_name="query_results.csv",
             mime="text/csv"
         )
 
     st.markdown("</div>", unsafe_allow_html=True)
 
+# Function to read the app stylesheet, cached so the file is only read once
+@st.cache_data(show_spinner=False)
+def load_css():
+    return Path(__file__).with_name("styles.css").read_text(encoding="utf-8")
+
 # Page Config
 st.set_page_config(page_title="IntelliSQL", page_icon="🧠", layout="wide")
 
 # --- CSS Styling ---
-st.markdown('''
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Orbitron:wght@500&family=Roboto+Mono&display=swap');
-
-html, body, .stApp {
-    background: linear-gradient(135deg, #0d0d0d, #1a0000);
-    color: white;
-    font-family: 'Orbitron', sans-serif;
-    scroll-behavior: smooth;
-    transition: all 0.4s ease;
-}
-
-.main-title {
-    font-size: 3rem;
-    text-align: center;
-    color: #ff1a1a;
-    animation: flicker 1.5s infinite alternate;
-    text-shadow: 0 0 10px red, 0 0 20px crimson, 0 0 30px darkred;
-}
-@keyframes flicker {
-    0% { opacity: 1; }
-    50% { opacity: 0.75; }
-    100% { opacity: 1; }
-}
-
-.subtitle {
-    text-align: center;
-    font-size: 1.4rem;
-    color: #ff9999;
-    margin-bottom: 2rem;
-    font-family: 'Roboto Mono', monospace;
-    animation: slide-up 1.5s ease;
-}
-@keyframes slide-up {
-    from { transform: translateY(20px); opacity: 0; }
-    to { transform: translateY(0); opacity: 1; }
-}
-
-.description-box {
-    background: rgba(255, 255, 255, 0.08);
-    border-radius: 20px;
-    padding: 1.5rem;
-    backdrop-filter: blur(6px);
-    box-shadow: 0 0 10px rgba(255, 0, 0, 0.4);
-    margin-bottom: 2rem;
-}
-
-.upload-box {
-    background: rgba(255, 255, 255, 0.05);
-    border-radius: 15px;
-    padding: 1.5rem;
-    margin-bottom: 2rem;
-    border: 1px dashed #ff4d4d;
-}
-
-.schema {
-    font-family: 'Roboto Mono', monospace;
-    background-color: rgba(255, 255, 255, 0.07);
-    padding: 1rem;
-    border-radius: 12px;
-    margin-top: 1rem;
-    color: #66ffff;
-    font-size: 0.9rem;
-    border-left: 4px solid #ff1a1a;
-}
-
-.stTextInput > label {
-    font-size: 1.4rem !important;
-    font-weight: 600;
-    color: #00ffff;
-    font-family: 'Orbitron', sans-serif;
-}
-
-.stTextInput > div > input {
-    background-color: rgba(0,0,0,0.5);
-    color: #00ffff;
-    border: 1px solid #00ffff;
-    border-radius: 10px;
-    padding: 0.6rem;
-    transition: 0.3s;
-}
-
-.stButton button {
-    background: linear-gradient(135deg, #ff0000, #990000);
-    color: white;
-    border: none;
-    border-radius: 10px;
-    font-weight: bold;
-    padding: 0.6rem 1.5rem;
-    transition: transform 0.3s;
-}
-
-.response {
-    animation: glowFade 1s ease;
-    background: rgba(255, 255, 255, 0.05);
-    padding: 1rem;
-    border-radius: 15px;
-    box-shadow: 0 0 10px #ff4d4d;
-    margin-top: 1rem;
-}
-
-.footer {
-    text-align: center;
-    margin-top: 2rem;
-    font-size: 0.9rem;
-    color: #999;
-}
-</style>
-''', unsafe_allow_html=True)
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
 # --- Title & Subtitle ---
 st.markdown("<h1 class='main-title'>IntelliSQL - Ask Your Database</h1>", unsafe_allow_html=True)
@@ -356,14 +395,20 @@ No database content is ever stored or backed up by the admin or on any external
 
 
 # Initialize session state
-if 'db_path' not in st.session_state:
-    st.session_state['db_path'] = None
-if 'schema_info' not in st.session_state:
-    st.session_state['schema_info'] = None
-if 'prompt' not in st.session_state:
-    st.session_state['prompt'] = None
+if 'conn' not in st.session_state:
+    st.session_state['conn'] = None
+if 'is_sample' not in st.session_state:
+    st.session_state['is_sample'] = False
+if 'tmp_path' not in st.session_state:
+    st.session_state['tmp_path'] = None
+if 'db_key' not in st.session_state:
+    st.session_state['db_key'] = None
 if 'uploaded_file_name' not in st.session_state:
     st.session_state['uploaded_file_name'] = None
+if 'upload_file_id' not in st.session_state:
+    st.session_state['upload_file_id'] = None
+if 'upload_digest' not in st.session_state:
+    st.session_state['upload_digest'] = None
 
 # --- Database Upload Section ---
 st.markdown("<div class='upload-box'>", unsafe_allow_html=True)
@@ -373,65 +418,73 @@ st.write("Upload your SQLite database file (.db, .sqlite, .sqlite3) to start que
 uploaded_file = st.file_uploader("Choose a database file", type=['db', 'sqlite', 'sqlite3'])
 
 if uploaded_file:
-    # Create a temporary directory to store the uploaded file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_path = tmp_file.name
+    # Hash the upload once per file_id so reruns with the same file hit the schema cache
+    # Read in chunks so the file is never copied into one bytes object
+    if uploaded_file.file_id != st.session_state['upload_file_id']:
+        hasher = hashlib.blake2b()
+        uploaded_file.seek(0)
+        for chunk in iter(lambda: uploaded_file.read(COPY_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+        st.session_state['upload_file_id'] = uploaded_file.file_id
+        st.session_state['upload_digest'] = hasher.hexdigest()
+    db_key = st.session_state['upload_digest']
 
-    # Store the path and filename in session state
-    st.session_state['db_path'] = tmp_path
-    st.session_state['uploaded_file_name'] = uploaded_file.name
-
-    # Extract schema information
     try:
-        schema_info = extract_schema_info(tmp_path)
-        st.session_state['schema_info'] = schema_info
+        if db_key != st.session_state['db_key']:
+            # Drop the previous database before switching to the new upload
+            release_db()
+
+            # Create a temporary directory to store the uploaded file
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as tmp_file:
+                uploaded_file.seek(0)
+                shutil.copyfileobj(uploaded_file, tmp_file, COPY_CHUNK_SIZE)
+                tmp_path = tmp_file.name
+
+            st.session_state['tmp_path'] = tmp_path
+            st.session_state['conn'] = open_conn(tmp_path)
 
-        # Generate the prompt
-        prompt = generate_prompt(schema_info)
-        st.session_state['prompt'] = prompt
+            # On POSIX the open connection keeps the file alive, so unlink it right away;
+            # the OS reclaims it when the connection closes, even if the session dies
+            if os.name == 'posix':
+                os.unlink(tmp_path)
+                st.session_state['tmp_path'] = None
+
+            # Store the key and filename in session state
+            st.session_state['db_key'] = db_key
+            st.session_state['uploaded_file_name'] = uploaded_file.name
+
+        # Extract schema information
+        schema_info = extract_schema_info(db_key, st.session_state['conn'])
 
         # Display success message
         st.success(f"Database '{uploaded_file.name}' uploaded successfully! Found {len(schema_info)} tables.")
 
     except Exception as e:
         st.error(f"Error processing database: {e}")
-        st.session_state['db_path'] = None
-        st.session_state['schema_info'] = None
-        st.session_state['prompt'] = None
-        st.session_state['uploaded_file_name'] = None
+        release_db()
 
 st.markdown("</div>", unsafe_allow_html=True)
 
+# Resolve schema and prompt for the active database (served from cache on reruns)
+schema_info = None
+prompt = None
+if st.session_state['conn']:
+    schema_info = extract_schema_info(st.session_state['db_key'], st.session_state['conn'])
+    prompt = generate_prompt(schema_info)
+
 # --- Schema Display Section ---
-if st.session_state['schema_info']:
+if schema_info:
     with st.expander("📋 View Database Schema", expanded=False):
-        for table_name, info in st.session_state['schema_info'].items():
+        for table_name, col_html, fk_html in render_schema_html(schema_info):
             st.markdown(f"**📊 Table: {table_name}**")
-
-            columns = info['columns']
-            foreign_keys = info['foreign_keys']
-
-            # Create column information display
-            col_info = ""
-            for col in columns:
-                col_type = col['type']
-                pk = "🔑 " if col['primary_key'] else ""
-                nullable = "NULL" if col['nullable'] else "NOT NULL"
-                default = f" (default: {col['default']})" if col['default'] is not None else ""
-                col_info += f"{pk}{col['name']} → {col_type}, {nullable}{default}\n"
-
-            st.markdown(f"<div class='schema'><pre>{col_info}</pre></div>", unsafe_allow_html=True)
+            st.markdown(col_html, unsafe_allow_html=True)
 
             # Display foreign keys if any
-            if foreign_keys:
-                fk_info = "Foreign Keys:\n"
-                for fk in foreign_keys:
-                    fk_info += f"  {fk['from']} → {fk['to_table']}.{fk['to_column']}\n"
-                st.markdown(f"<div class='schema'><pre>{fk_info}</pre></div>", unsafe_allow_html=True)
+            if fk_html:
+                st.markdown(fk_html, unsafe_allow_html=True)
 
 # --- Query Section ---
-if st.session_state['db_path'] and st.session_state['schema_info'] and st.session_state['prompt']:
+if st.session_state['conn'] and schema_info and prompt:
     st.subheader("🔍 Query Your Database")
 
     if st.session_state['uploaded_file_name']:
@@ -440,10 +493,10 @@ if st.session_state['db_path'] and st.session_state['schema_info'] and st.sessio
     st.write("Ask questions about your data in plain English, and we'll convert it to SQL and run the query.")
 
     # Provide example questions based on the schema
-    schema_tables = list(st.session_state['schema_info'].keys())
+    schema_tables = list(schema_info.keys())
     if schema_tables:
         first_table = schema_tables[0]
-        first_columns = st.session_state['schema_info'][first_table]['columns']
+        first_columns = schema_info[first_table]['columns']
 
         example_questions = []
         example_questions.append(f"How many records are in {first_table}?")
@@ -457,16 +510,17 @@ if st.session_state['db_path'] and st.session_state['schema_info'] and st.sessio
 
         st.info(f"💡 Example questions you can ask:\n" + "\n".join([f"• {q}" for q in example_questions]))
 
-    # Input for query
-    que = st.text_input("📝 Enter your English question here:")
-    submit = st.button("🚀 Generate SQL & Run")
+    # Input for query, batched in a form so typing doesn't trigger reruns
+    with st.form("query_form"):
+        que = st.text_input("📝 Enter your English question here:")
+        submit = st.form_submit_button("🚀 Generate SQL & Run")
 
     # Processing
     if submit and que:
         try:
             with st.spinner("Generating SQL query..."):
-                response = get_response(que, st.session_state['prompt'])
-                cleaned_sql = response.strip().replace("```sql", "").replace("```", "").strip()
+                response = get_response(que, prompt)
+                cleaned_sql = FENCE_RE.sub("", response).strip()
 
             # Display the generated SQL
             st.markdown(f"<h4>🔍 Generated SQL:</h4>", unsafe_allow_html=True)
@@ -477,12 +531,16 @@ if st.session_state['db_path'] and st.session_state['schema_info'] and st.sessio
                 st.error("❌ Invalid SQL generated. Please try rephrasing your question or ensure you're asking for data retrieval.")
             else:
                 with st.spinner("Executing query..."):
+                    conn = st.session_state['conn']
+
+                    # Compile the query first so invalid SQL is rejected before it runs
+                    validate_sql(cleaned_sql, conn)
+
                     # Run the query
-                    result = read_query(cleaned_sql, st.session_state['db_path'])
-                    col_names = get_column_names(cleaned_sql, st.session_state['db_path'])
+                    result, col_names = run_select(cleaned_sql, conn)
 
                     # Display results
-                    display_query_results(result, col_names)
+                    display_query_results(result, col_names, cleaned_sql, conn)
 
         except Exception as e:
             st.error(f"❌ Error occurred: {str(e)}")
@@ -494,48 +552,37 @@ else:
     st.info("👆 Please upload a database file to start querying.")
 
 # --- Default Database Option ---
-if not st.session_state['db_path']:
+if not st.session_state['conn']:
     st.markdown("<div class='upload-box'>", unsafe_allow_html=True)
     st.subheader("🚀 Quick Start with Sample Database")
     st.write("Don't have a database file? Use our sample student database to try out the app.")
 
     if st.button("Use Sample Database"):
         if os.path.exists("data.db"):
-            st.session_state['db_path'] = "data.db"
-            st.session_state['uploaded_file_name'] = "Sample Student Database"
-
             try:
-                schema_info = extract_schema_info("data.db")
-                st.session_state['schema_info'] = schema_info
+                st.session_state['conn'] = get_conn("data.db")
+                st.session_state['is_sample'] = True
+                st.session_state['db_key'] = str(os.path.getmtime("data.db"))
+                st.session_state['uploaded_file_name'] = "Sample Student Database"
 
-                prompt = generate_prompt(schema_info)
-                st.session_state['prompt'] = prompt
+                schema_info = extract_schema_info(st.session_state['db_key'], st.session_state['conn'])
 
                 st.success(f"Sample database loaded successfully! Found {len(schema_info)} tables.")
                 st.rerun()
 
             except Exception as e:
                 st.error(f"Error loading sample database: {e}")
-                st.session_state['db_path'] = None
-                st.session_state['schema_info'] = None
-                st.session_state['prompt'] = None
-                st.session_state['uploaded_file_name'] = None
+                release_db()
         else:
             st.error("Sample database (data.db) not found. Please upload your own database file.")
 
     st.markdown("</div>", unsafe_allow_html=True)
 
 # Clear database button
-if st.session_state['db_path']:
+if st.session_state['conn']:
     if st.button("🗑️ Clear Current Database"):
-        # Clean up temporary file if it exists
-        if st.session_state['db_path'] != "data.db" and os.path.exists(st.session_state['db_path']):
-            os.unlink(st.session_state['db_path'])
-
-        st.session_state['db_path'] = None
-        st.session_state['schema_info'] = None
-        st.session_state['prompt'] = None
-        st.session_state['uploaded_file_name'] = None
+        # Close the connection and clean up the temporary file if it's still on disk
+        release_db()
         st.rerun()
 
 # --- Footer ---